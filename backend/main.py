@@ -3,7 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
 import asyncio
-import json
+import orjson
 from telegram_service import TelegramService, logger
 
 app = FastAPI(title="Telephasma Pro 2.0")
@@ -19,6 +19,22 @@ app.add_middleware(
 
 tg = TelegramService()
 
+@app.on_event("shutdown")
+async def shutdown():
+    await tg.shutdown()
+
+# orjson handles int keys (resolved_users) and datetimes (gift dates) natively
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+_STATUS_DONE = orjson.dumps({"type": "status", "message": "Scan Comprehensive - Complete"})
+_ERROR_PREFIX = b'{"type":"error","message":'
+
+def _encode(update):
+    return orjson.dumps(update, option=_ORJSON_OPTS)
+
+def _error_frame(message):
+    """Error frame from a pre-serialized template; only the message is encoded."""
+    return _ERROR_PREFIX + orjson.dumps(message) + b'}'
+
 # --- Models ---
 class LoginRequest(BaseModel):
     api_id: str
@@ -70,16 +86,45 @@ async def stop_scan_endpoint():
 
 
 # --- Intelligence WebSocket ---
+_SEND_QUEUE_SIZE = 256
+_SEND_BATCH = 32
+
+async def _drain(outq, websocket):
+    """Forward encoded frames to the client until the None sentinel arrives."""
+    try:
+        while True:
+            batch = [await outq.get()]
+            while len(batch) < _SEND_BATCH and not outq.empty():
+                batch.append(outq.get_nowait())
+            for payload in batch:
+                if payload is None: return
+                await websocket.send_bytes(payload)
+    except BaseException:
+        # Free a producer blocked on a full queue so it can observe the failure
+        while not outq.empty(): outq.get_nowait()
+        raise
+
+async def _enqueue(outq, drain, payload):
+    """Queue a frame, surfacing drainer failures (e.g. disconnects) to the scan loop."""
+    if drain.done(): drain.result()
+    await outq.put(payload)
+
 @app.websocket("/ws/scan/{chat_id}")
 async def websocket_scan(websocket: WebSocket, chat_id: str):
     await websocket.accept()
     
+    # Decouple scanning from socket backpressure
+    outq = asyncio.Queue(_SEND_QUEUE_SIZE)
+    drain = asyncio.create_task(_drain(outq, websocket))
+    
     try:
         # 1. Configuration handshake
         params = websocket.query_params
         depth = int(params.get("depth", 1))
         delay = float(params.get("delay", 1.5))
+        concurrency = int(params.get("concurrency", 4))
         recursive = params.get("recursive", "true").lower() == "true"
+        gifts_always = params.get("gifts_always", "true").lower() == "true"
         custom_targets = params.get("targets")
         
         target_identifiers = None
@@ -96,31 +141,43 @@ async def websocket_scan(websocket: WebSocket, chat_id: str):
                 else:
                     target_identifiers.append(t)
 
-        logger.info(f"Scan Start | Chat: {chat_id} | Depth: {depth} | Delay: {delay}")
+        logger.info(f"Scan Start | Chat: {chat_id} | Depth: {depth} | Delay: {delay} | Concurrency: {concurrency}")
         
         # 2. Execution Loop
         async for update in tg.scan_chat_recursive(
             chat_id, 
             depth=depth if recursive else 0,
             delay=delay,
-            target_identifiers=target_identifiers
+            target_identifiers=target_identifiers,
+            concurrency=concurrency,
+            gifts_always=gifts_always
         ):
-            await websocket.send_text(json.dumps(update))
+            await _enqueue(outq, drain, _encode(update))
             
-        await websocket.send_text(json.dumps({"type": "status", "message": "Scan Comprehensive - Complete"}))
+        await _enqueue(outq, drain, _STATUS_DONE)
+        await _enqueue(outq, drain, None)
+        await drain
         
     except WebSocketDisconnect:
         logger.info(f"WebSocket client disconnected for chat {chat_id}")
     except Exception as e:
         logger.critical(f"WebSocket Crash: {e}")
         try:
-            await websocket.send_text(json.dumps({"type": "error", "message": str(e)}))
+            await _enqueue(outq, drain, _error_frame(str(e)))
+            await _enqueue(outq, drain, None)
+            await drain
         except: pass
     finally:
+        if not drain.done():
+            drain.cancel()
+            try:
+                await drain
+            except (asyncio.CancelledError, Exception): pass
         try:
             await websocket.close()
         except: pass
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" selects uvloop when installed (not available on Windows), else stdlib asyncio
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto")
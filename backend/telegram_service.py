@@ -1,8 +1,11 @@
 import logging
 import asyncio
 import re
+from collections import deque
 from telethon import TelegramClient, functions, types, errors
 from telethon.errors import FloodWaitError, UserPrivacyRestrictedError
+from telethon.tl.functions.messages import GetCommonChatsRequest
+from telethon.tl.types import PeerUser, PeerChannel, PeerChat
 
 # --- Configure Structured Logging ---
 logging.basicConfig(
@@ -11,19 +14,45 @@ logging.basicConfig(
 )
 logger = logging.getLogger("Telephasma.Backend")
 
+_BLACKLIST = frozenset({'nohello', 'nohello.org', 'nohello.com', 'nohello.net', 'hello', 'example', 'test', 'username'})
+
+# Peer type -> attribute holding its raw id
+_PEER_ATTR = {PeerUser: 'user_id', PeerChannel: 'channel_id', PeerChat: 'chat_id'}
+
+KEEPALIVE_INTERVAL = 240 # seconds between idle pings
+
+_NULL_TABLE = str.maketrans('', '', '\x00')
+
 def clean_text(text):
     """Sanitize text for safe frontend rendering."""
-    if not text: return ""
     # Remove any potentially dangerous characters or null bytes
-    return text.replace('\x00', '').strip()
+    return text.translate(_NULL_TABLE).strip() if text else ""
 
 class TelegramService:
+    # Bio intelligence: @handles and t.me links share one pass
+    _LINK_RE = re.compile(
+        r"@(?P<user>[a-zA-Z][\w\d_]{4,31})"
+        r"|(?:https?:\/\/)?t\.me\/(?P<tme>\+?[a-zA-Z0-9_\-]+)",
+        re.IGNORECASE
+    )
+    # Domains get their own pass: they overlap @handles (@brand.io) and emails (john@company.com)
+    _DOMAIN_RE = re.compile(
+        r"(?:https?:\/\/)?([a-zA-Z0-9][\w\-]*\.(?:io|com|net|org|in|ag|co|me|ru|cc|gg|xyz|dev|app))",
+        re.IGNORECASE
+    )
+
     def __init__(self):
         self.client = None
         self.phone = None
         self.api_id = None
         self.api_hash = None
         self.stop_requested = False
+        self.scan_gifts_always = True # Default: fetch gifts even for users without bio/channel
+        self._peer_cache = {} # dialog/entity id -> entity
+        self._peer_cache_warm = False
+        self._peer_cache_lock = asyncio.Lock()
+        self._keepalive_task = None
+        self._active_scans = 0
 
     def stop_scan(self):
         """Signal all running scans to stop immediately."""
@@ -35,6 +64,12 @@ class TelegramService:
 
     async def connect(self, api_id, api_hash, phone):
         """Cleanly initialize and connect the Telegram client with retry logic for DB locks."""
+        # Reuse the live client for the same account instead of reopening its session DB
+        if (self.client is not None and self.is_connected()
+                and self.api_id == str(api_id) and self.api_hash == str(api_hash) and self.phone == str(phone)):
+            logger.info(f"Reusing existing Telegram connection for {self.phone}")
+            return
+
         self.api_id = str(api_id)
         self.api_hash = str(api_hash)
         self.phone = str(phone)
@@ -53,6 +88,9 @@ class TelegramService:
                     timeout=45
                 )
                 await self.client.connect()
+                self._peer_cache.clear()
+                self._peer_cache_warm = False
+                self._start_keepalive()
                 logger.info(f"Connected to Telegram for {self.phone}")
                 return # Connection successful, exit loop
             except Exception as e:
@@ -68,6 +106,31 @@ class TelegramService:
                     logger.error(f"Connection failed: {e}")
                     raise
 
+    def _start_keepalive(self):
+        if self._keepalive_task is None or self._keepalive_task.done():
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+
+    async def _keepalive(self):
+        """Ping Telegram while idle so the next scan never pays a reconnect handshake."""
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if self._active_scans or not self.is_connected(): continue
+            try:
+                await self.client.get_me()
+            except Exception as e:
+                logger.warning(f"Keepalive ping failed: {e}")
+
+    async def shutdown(self):
+        """Stop background tasks and close the Telegram connection."""
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+            try:
+                await self._keepalive_task
+            except asyncio.CancelledError: pass
+            self._keepalive_task = None
+        if self.client:
+            await self.client.disconnect()
+
     async def send_code(self):
         """Send authentication code to the phone provided."""
         if not await self.client.is_user_authorized():
@@ -138,6 +201,18 @@ class TelegramService:
                 return None
         return None
 
+    async def _warm_peer_cache(self):
+        """Index recent dialogs once so numeric identifiers resolve without re-fetching."""
+        async with self._peer_cache_lock:
+            if self._peer_cache_warm: return
+            try:
+                for dialog in await self.client.get_dialogs(limit=500):
+                    self._peer_cache[dialog.id] = dialog.entity
+                    self._peer_cache[dialog.entity.id] = dialog.entity
+                self._peer_cache_warm = True
+            except Exception as e:
+                logger.warning(f"Dialog iteration for cache population failed: {e}")
+
     async def resolve_peer(self, identifier):
         """Robustly resolve various Telegram identifier formats."""
         if not identifier: return None
@@ -152,13 +227,11 @@ class TelegramService:
             if clean_id.lstrip('-').isdigit():
                 numeric_id = int(clean_id)
                 # For numeric IDs, try to find the entity in dialogs first (cache population)
-                try:
-                    async for dialog in self.client.iter_dialogs(limit=200):
-                        if dialog.id == numeric_id or dialog.entity.id == abs(numeric_id):
-                            logger.info(f"Found entity {numeric_id} in dialogs cache")
-                            return dialog.entity
-                except Exception as e:
-                    logger.warning(f"Dialog iteration for cache population failed: {e}")
+                await self._warm_peer_cache()
+                entity = self._peer_cache.get(numeric_id) or self._peer_cache.get(abs(numeric_id))
+                if entity is not None:
+                    logger.info(f"Found entity {numeric_id} in dialogs cache")
+                    return entity
                 
                 # Return the numeric ID anyway, let Telethon try
                 return numeric_id
@@ -178,7 +251,7 @@ class TelegramService:
         
         dialogs = []
         try:
-            async for dialog in self.client.iter_dialogs(limit=100):
+            for dialog in await self.client.get_dialogs(limit=100):
                 if dialog.is_group or dialog.is_channel:
                     dtype = "group"
                     if dialog.is_channel: dtype = "channel"
@@ -201,7 +274,7 @@ class TelegramService:
         try:
             peer = await self.resolve_peer(chat_id)
             entity = await self.client.get_entity(peer)
-            async for user in self.client.iter_participants(entity, limit=500, aggressive=True):
+            async for user in self.client.iter_participants(entity, limit=500):
                 if user.deleted: continue
                 members.append({
                     "id": user.id,
@@ -220,7 +293,6 @@ class TelegramService:
             # Resolve peer first to handle string/int mismatches
             peer = await self.resolve_peer(user_id)
             target = await self.client.get_input_entity(peer)
-            from telethon.tl.functions.messages import GetCommonChatsRequest
             result = await self.safe_call(self.client, GetCommonChatsRequest(
                 user_id=target,
                 max_id=0,
@@ -251,12 +323,9 @@ class TelegramService:
             
             gifts = []
             for gift in getattr(result, 'gifts', []):
-                sender_id = None
                 from_id = getattr(gift, 'from_id', None)
-                
-                if isinstance(from_id, types.PeerUser): sender_id = from_id.user_id
-                elif isinstance(from_id, types.PeerChannel): sender_id = from_id.channel_id
-                elif isinstance(from_id, types.PeerChat): sender_id = from_id.chat_id
+                attr = _PEER_ATTR.get(type(from_id))
+                sender_id = getattr(from_id, attr) if attr else None
                 
                 g_date = getattr(gift, 'date', None)
                 g_msg = getattr(gift, 'message', None)
@@ -265,7 +334,7 @@ class TelegramService:
                 gifts.append({
                     "id": getattr(gift, 'id', 0),
                     "sender_id": sender_id,
-                    "date": g_date.isoformat() if hasattr(g_date, 'isoformat') else str(g_date),
+                    "date": g_date if hasattr(g_date, 'isoformat') else str(g_date),
                     "message": clean_text(str(g_msg or "")),
                     "stars": getattr(gift, 'stars', 0)
                 })
@@ -279,18 +348,43 @@ class TelegramService:
     def extract_links(self, text):
         """RE-Optimized regex-based intelligence gathering from bios."""
         if not text: return []
-        blacklist = {'nohello', 'nohello.org', 'nohello.com', 'nohello.net', 'hello', 'example', 'test', 'username'}
         links = []
-        patterns = [
-            r"@([a-zA-Z][\w\d_]{4,31})",
-            r"(?:https?:\/\/)?t\.me\/(\+?[a-zA-Z0-9_\-]+)",
-            r"(?:https?:\/\/)?([a-zA-Z0-9][\w\-]*\.(?:io|com|net|org|in|ag|co|me|ru|cc|gg|xyz|dev|app))"
-        ]
-        for p in patterns:
-            links.extend(re.findall(p, text, re.IGNORECASE))
-        return [l for l in set(links) if l.lower() not in blacklist]
-
-    async def scan_user(self, peer, depth=0):
+        for m in self._LINK_RE.finditer(text):
+            links.append(m.group(m.lastgroup))
+        links.extend(self._DOMAIN_RE.findall(text))
+        return [l for l in dict.fromkeys(links) if l.lower() not in _BLACKLIST]
+
+    async def scan_users_batch(self, peers):
+        """Bulk pre-pass: fetch short User records via users.GetUsers before any GetFullUser call.
+
+        Returns a list aligned with `peers`; None marks targets not worth a full scan.
+        """
+        peers = list(peers)
+        pending = [] # (index, InputPeerUser)
+        for i, p in enumerate(peers):
+            if isinstance(p, types.User): continue # Already have the short record
+            try:
+                # Session cache only: the bulk request below must be the sole RPC
+                inp = self.client.session.get_input_entity(p)
+            except Exception:
+                continue # Not cached; scan_user resolves it as before
+            if isinstance(inp, types.InputPeerUser): pending.append((i, inp))
+        
+        for start in range(0, len(pending), 100):
+            if self.stop_requested: break
+            chunk = pending[start:start + 100]
+            users = await self.safe_call(self.client, functions.users.GetUsersRequest(
+                id=[types.InputUser(inp.user_id, inp.access_hash) for _, inp in chunk]
+            ))
+            if not users: continue # Leave peers untouched; scan_user will retry them
+            by_id = {u.id: u for u in users if isinstance(u, types.User)}
+            for i, inp in chunk:
+                peers[i] = by_id.get(inp.user_id)
+        
+        # Deleted accounts (and ids GetUsers could not return) never have a bio or gifts
+        return [None if isinstance(p, types.User) and p.deleted else p for p in peers]
+
+    async def scan_user(self, peer, depth=0, gifts_always=None):
         """Single user analysis component."""
         try:
             if self.stop_requested: return None
@@ -298,7 +392,15 @@ class TelegramService:
             if self.stop_requested: return None
             if not full: return None
             
+            # Fast path: no bio and no personal channel means no links; the gifts RPC is
+            # only worth paying for when graph expansion through gifts is requested
+            if (not full.full_user.about and not getattr(full.full_user, 'personal_channel_id', None)
+                    and not (self.scan_gifts_always if gifts_always is None else gifts_always)):
+                return None
+            
             u_obj = full.users[0]
+            # Gifts RPC is independent of bio parsing; overlap it with the channel lookup
+            gifts_task = asyncio.create_task(self.get_user_gifts(u_obj))
             bio = clean_text(full.full_user.about or "")
             links = self.extract_links(bio)
             
@@ -310,13 +412,13 @@ class TelegramService:
                 except: pass
             
             if u_obj.username and u_obj.username in links: links.remove(u_obj.username)
-            gifts, rels = await self.get_user_gifts(u_obj)
+            gifts, rels = await gifts_task
             
             return {
                 "u_id": u_obj.id,
                 "u_obj": u_obj,
                 "bio": bio,
-                "links": list(set(links)),
+                "links": list(dict.fromkeys(links)),
                 "gifts": gifts,
                 "related_users": rels
             }
@@ -324,7 +426,12 @@ class TelegramService:
             logger.warning(f"Scan failed for peer {peer}: {e}")
             return None
 
-    async def scan_chat_recursive(self, chat_identifier, depth=1, delay=1.5, target_identifiers=None):
+    @staticmethod
+    def _norm_id(x):
+        """Canonical visited-set key: absolute int id of an entity or raw id."""
+        return abs(int(x.id if hasattr(x, 'id') else x))
+
+    async def scan_chat_recursive(self, chat_identifier, depth=1, delay=1.5, target_identifiers=None, concurrency=4, gifts_always=None, seed_limit=400):
         """Professional Recursive Intelligence Mapper."""
         # Only reset stop flag if we are starting a fresh new run and not currently stopping
         # For simplicity, we assume a new call means a new intention, but we must respect an ongoing stop command if it was just issued.
@@ -333,8 +440,15 @@ class TelegramService:
         self.stop_requested = False 
         
         visited = set()
-        queue = [] # (peer, depth, from_who)
+        queue = deque() # (peer, depth, from_who)
+        concurrency = max(1, int(concurrency))
+        sem = asyncio.Semaphore(concurrency)
+
+        async def guarded(p):
+            async with sem:
+                return await self.scan_user(p, gifts_always=gifts_always)
         
+        self._active_scans += 1 # Suspends idle keepalive pings
         try:
             if target_identifiers:
                 # Handle custom list of targets (IDs or Usernames)
@@ -346,96 +460,109 @@ class TelegramService:
                          if peer:
                              queue.append((peer, 0, None))
                              # Add to visited to avoid cycle if it appears again
-                             if isinstance(peer, int): visited.add(peer)
-                             elif hasattr(peer, 'id'): visited.add(peer.id)
+                             if isinstance(peer, int) or hasattr(peer, 'id'): visited.add(self._norm_id(peer))
                      except Exception as e:
                          logger.warning(f"Could not resolve initial target {target}: {e}")
             else:
                 # Default behavior: Scan participants of a chat
                 peer = await self.resolve_peer(chat_identifier)
                 entity = await self.client.get_entity(peer)
-                async for user in self.client.iter_participants(entity, limit=400, aggressive=True):
+                # Default filter only: aggressive mode fans out into per-letter searches (FloodWait bait)
+                users_seen = 0
+                async for user in self.client.iter_participants(entity, limit=500):
                     if self.stop_requested: 
                         logger.info("Scan Aborted during participant fetch.")
                         break # Check stop flag
                     if user.bot or user.deleted: continue
                     queue.append((user, 0, None))
-                    visited.add(user.id)
+                    visited.add(self._norm_id(user))
+                    users_seen += 1
+                    if users_seen >= seed_limit: break # Seed budget met
             
             while queue:
                 if self.stop_requested:
                     logger.info("Scan Aborted during queue processing.")
                     break # Check stop flag
 
-                peer, c_depth, from_who = queue.pop(0)
-                if delay > 0: await asyncio.sleep(delay)
-
-                if self.stop_requested: break # Check again after delay
-
-                result = await self.scan_user(peer)
-                if not result: continue
-
-                u_id = result["u_id"]
-                u_obj = result["u_obj"]
-                links = result["links"]
-                gifts = result["gifts"]
-                rels = result["related_users"]
-
-                # Emit data only if relevant (Strict Filtering: Only users with links are "Found")
-                if links:
-                    yield {
-                        "type": "user_found", 
-                        "data": {
-                            "id": u_id, "username": u_obj.username, "first_name": clean_text(u_obj.first_name),
-                            "type": "channel_owner",
-                            "depth": c_depth, "discovered_from": from_who
-                        }
-                    }
-                    yield {
-                        "type": "user_detail", 
-                        "data": {"id": u_id, "bio": result["bio"], "channel_links": links, "username": u_obj.username}
-                    }
-
-                # Always yield gifts if present, for graph connectivity and parsing (even if user isn't shown yet)
-                # But we add related_users for name resolution
-                if gifts: 
-                    # Serialize related_users for frontend name resolution
-                    resolved_users = {}
-                    for rid, ruser in rels.items():
-                         resolved_users[rid] = {
-                             "username": getattr(ruser, 'username', None),
-                             "first_name": clean_text(getattr(ruser, 'first_name', ""))
-                         }
+                # Pre-filter one wave with bulk GetUsers, then scan it concurrently in chunks
+                wave = [queue.popleft() for _ in range(min(100, len(queue)))]
+                peers = await self.scan_users_batch(p for p, _, _ in wave)
+                wave = [(p, d, f) for p, (_, d, f) in zip(peers, wave) if p is not None]
+
+                for start in range(0, len(wave), concurrency):
+                    batch = wave[start:start + concurrency]
+                    if delay > 0: await asyncio.sleep(delay)
+
+                    if self.stop_requested: break # Check again after delay
+
+                    results = await asyncio.gather(*(guarded(p) for p, _, _ in batch))
+
+                    for (peer, c_depth, from_who), result in zip(batch, results):
+                        if not result: continue
+
+                        u_id = result["u_id"]
+                        u_obj = result["u_obj"]
+                        links = result["links"]
+                        gifts = result["gifts"]
+                        rels = result["related_users"]
+
+                        # Emit data only if relevant (Strict Filtering: Only users with links are "Found")
+                        # Built once; re-emitted after gifts so the detail view stays in sync
+                        detail = None
+                        if links:
+                            detail = {
+                                "type": "user_detail", 
+                                "data": {"id": u_id, "bio": result["bio"], "channel_links": links, "username": u_obj.username}
+                            }
+                            yield {
+                                "type": "user_found", 
+                                "data": {
+                                    "id": u_id, "username": u_obj.username, "first_name": clean_text(u_obj.first_name),
+                                    "type": "channel_owner",
+                                    "depth": c_depth, "discovered_from": from_who
+                                }
+                            }
+                            yield detail
+
+                        # Always yield gifts if present, for graph connectivity and parsing (even if user isn't shown yet)
+                        # But we add related_users for name resolution
+                        if gifts: 
+                            # Serialize related_users for frontend name resolution
+                            resolved_users = {}
+                            for rid, ruser in rels.items():
+                                 resolved_users[rid] = {
+                                     "username": getattr(ruser, 'username', None),
+                                     "first_name": clean_text(getattr(ruser, 'first_name', ""))
+                                 }
                     
-                    yield {
-                        "type": "user_gifts", 
-                        "data": {
-                            "user_id": u_id, 
-                            "gifts": gifts,
-                            "resolved_users": resolved_users
-                        }
-                    }
-                    if links:
-                        yield {
-                            "type": "user_detail", 
-                            "data": {"id": u_id, "bio": result["bio"], "channel_links": links, "username": u_obj.username}
-                        }
+                            yield {
+                                "type": "user_gifts", 
+                                "data": {
+                                    "user_id": u_id, 
+                                    "gifts": gifts,
+                                    "resolved_users": resolved_users
+                                }
+                            }
+                            if detail:
+                                yield detail
                     
-                # Expansion
-                if c_depth < depth:
-                    for g in gifts:
-                        if self.stop_requested: break # Check stop flag inside inner loop
-                        sid = g.get('sender_id')
-                        if not sid or sid in visited: continue
-                        visited.add(sid)
-                        speer = rels.get(sid) or sid
-                        # Intelligence: Pass a readable "Discovered From" label
-                        from_label = str(u_id)
-                        if u_obj.username: from_label = f"@{u_obj.username}"
-                        elif u_obj.first_name: from_label = u_obj.first_name
-                        queue.append((speer, c_depth + 1, from_label))
+                        # Expansion
+                        if c_depth < depth:
+                            for g in gifts:
+                                if self.stop_requested: break # Check stop flag inside inner loop
+                                sid = g.get('sender_id')
+                                if not sid or self._norm_id(sid) in visited: continue
+                                visited.add(self._norm_id(sid))
+                                speer = rels.get(sid) or sid
+                                # Intelligence: Pass a readable "Discovered From" label
+                                from_label = str(u_id)
+                                if u_obj.username: from_label = f"@{u_obj.username}"
+                                elif u_obj.first_name: from_label = u_obj.first_name
+                                queue.append((speer, c_depth + 1, from_label))
 
 
         except Exception as e:
             logger.critical(f"Recursive scan engine failure: {e}")
             yield {"type": "error", "message": f"Scan Critical: {str(e)}"}
+        finally:
+            self._active_scans -= 1
@@ -3,6 +3,8 @@ import { useStore } from '../store/useStore';
 import { Activity, Search, ExternalLink, Copy, Check, ChevronRight } from 'lucide-react';
 import { t } from '../lib/i18n';
 
+const frameDecoder = new TextDecoder();
+
 export const Scanner: React.FC = () => {
     const {
         scanTargetChatId, setSettings,
@@ -84,6 +86,7 @@ export const Scanner: React.FC = () => {
         addLog(chatId === 'custom' ? `Connecting to scan ${customScanTargets.length} selected users...` : `Connecting to ${chatId}...`);
 
         const ws = new WebSocket(`ws://localhost:8000/ws/scan/${chatId}?depth=${scanDepth}&delay=${scanDelay}`);
+        ws.binaryType = 'arraybuffer';
         wsRef.current = ws;
 
         ws.onopen = () => {
@@ -96,7 +99,9 @@ export const Scanner: React.FC = () => {
         };
 
         ws.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            // Backend emits UTF-8 JSON as binary frames
+            const raw = typeof event.data === 'string' ? event.data : frameDecoder.decode(event.data);
+            const data = JSON.parse(raw);
             if (data.type === 'complete') {
                 ws.close();
                 addLog(`Scan complete for ${chatId}.`);